@@ -0,0 +1,269 @@
+import argparse, asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import db
+import migrations
+from controller import Controller
+from db import EditConflict
+from serialize import task_to_json, task_dict_from_json, parse_status, parse_category
+
+
+# Local HTTP/JSON API over the Controller. Handlers are async; every database
+# call runs in its own session on a bounded thread pool.
+#
+#   GET    /tasks?status=&category=&limit=&offset=   (without descriptions)
+#   POST   /tasks
+#   GET    /tasks/{id}
+#   PATCH  /tasks/{id}            {..., "version": 2}
+#   DELETE /tasks/{id}?version=2
+#   POST   /tasks/status         {"ids": [1, 2], "status": "COMPLETE"}
+#
+# GET responses carry an ETag built from the task_instance revision counter,
+# so clients polling with If-None-Match get a 304 for the price of one lookup.
+# PATCH and DELETE take the task version the client last saw (optional); if
+# the task changed since, they answer 409 with the current task.
+
+DEFAULT_WORKERS = 4
+MAX_PAGE_SIZE = 1000
+
+executor_key = web.AppKey("executor", ThreadPoolExecutor)
+session_factory_key = web.AppKey("session_factory", object)
+
+
+# ---
+# HELPERS
+
+async def run_db(request:web.Request, func):
+    def call():
+        with request.app[session_factory_key]() as session:
+            return func(Controller(session))
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app[executor_key], call)
+
+
+def make_etag(revision:int) -> str:
+    return f'"tasks-{revision}"'
+
+
+def etag_matches(request:web.Request, etag:str) -> bool:
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def not_modified(etag:str) -> web.Response:
+    return web.Response(status=304, headers={"ETag": etag})
+
+
+def json_error(status:int, message:str) -> web.Response:
+    return web.json_response({"error": message}, status=status)
+
+
+def get_row_id(request:web.Request) -> int:
+    try:
+        return int(request.match_info["row_id"])
+    except ValueError:
+        raise web.HTTPNotFound()
+
+
+def parse_version(value) -> int | None:
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError("'version' should be an integer.")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("'version' should be an integer.")
+
+
+def conflict_response(conflict:EditConflict) -> web.Response:
+    if conflict.current is None:
+        return json_error(404, f"Task {conflict.row_id} was deleted.")
+    return web.json_response({
+        "error": f"Task {conflict.row_id} was changed since version {conflict.expected_version}.",
+        "task": task_to_json(conflict.current)
+    }, status=409)
+
+
+async def read_json(request:web.Request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise ValueError("Request body should be valid JSON.")
+
+
+def parse_list_query(query) -> dict:
+    filters = {"status": None, "category": None, "limit": 100, "offset": 0}
+    if "status" in query:
+        filters["status"] = parse_status(query["status"])
+    if "category" in query:
+        filters["category"] = parse_category(query["category"])
+    for key in ["limit", "offset"]:
+        if key in query:
+            try:
+                filters[key] = int(query[key])
+            except ValueError:
+                raise ValueError(f"'{key}' should be an integer.")
+            if filters[key] < 0:
+                raise ValueError(f"'{key}' can't be negative.")
+    if filters["limit"] < 1:
+        raise ValueError("'limit' should be at least 1.")
+    filters["limit"] = min(filters["limit"], MAX_PAGE_SIZE)
+    return filters
+
+
+@web.middleware
+async def error_middleware(request, handler):
+    try:
+        return await handler(request)
+    except ValueError as error:
+        return json_error(400, str(error))
+
+
+# ---
+# HANDLERS
+
+async def list_tasks(request:web.Request) -> web.Response:
+    filters = parse_list_query(request.query)
+
+    def work(controller):
+        etag = make_etag(controller.get_revision())
+        if etag_matches(request, etag):
+            return etag, None
+        return etag, [
+            task_to_json(task, include_description=False) for task in controller.get_tasks(**filters)
+        ]
+
+    etag, tasks = await run_db(request, work)
+    if tasks is None:
+        return not_modified(etag)
+    body = {"tasks": tasks, "limit": filters["limit"], "offset": filters["offset"]}
+    if len(tasks) == filters["limit"]:
+        body["next_offset"] = filters["offset"] + len(tasks)
+    return web.json_response(body, headers={"ETag": etag})
+
+
+async def get_task(request:web.Request) -> web.Response:
+    row_id = get_row_id(request)
+
+    def work(controller):
+        etag = make_etag(controller.get_revision())
+        # Looked up before If-None-Match is checked: "*" only matches a task
+        # that exists
+        task_instance = controller.get_task(row_id=row_id)
+        if task_instance is None:
+            return etag, False, None
+        if etag_matches(request, etag):
+            return etag, True, None
+        return etag, True, task_to_json(task_instance)
+
+    etag, exists, task = await run_db(request, work)
+    if not exists:
+        return json_error(404, f"No task with id {row_id}.")
+    if task is None:
+        return not_modified(etag)
+    return web.json_response({"task": task}, headers={"ETag": etag})
+
+
+async def create_task(request:web.Request) -> web.Response:
+    task_dict = task_dict_from_json(await read_json(request))
+
+    def work(controller):
+        task_instance = controller.add_task(task_dict=task_dict)
+        return task_to_json(task_instance) if task_instance else None
+
+    task = await run_db(request, work)
+    if task is None:
+        return json_error(500, "Couldn't create task.")
+    return web.json_response({"task": task}, status=201)
+
+
+async def edit_task(request:web.Request) -> web.Response:
+    row_id = get_row_id(request)
+    data = await read_json(request)
+    task_dict = task_dict_from_json(data, partial=True)
+    expected_version = parse_version(data.get("version"))
+
+    def work(controller):
+        result = controller.edit_task(row_id=row_id, task_dict=task_dict, expected_version=expected_version)
+        if isinstance(result, EditConflict):
+            return conflict_response(result)
+        if not result:
+            return json_error(404, f"No task with id {row_id}.")
+        return web.json_response({"task": task_to_json(result)})
+
+    return await run_db(request, work)
+
+
+async def delete_task(request:web.Request) -> web.Response:
+    row_id = get_row_id(request)
+    expected_version = parse_version(request.query.get("version"))
+
+    def work(controller):
+        result = controller.delete_task(row_id=row_id, expected_version=expected_version)
+        if isinstance(result, EditConflict):
+            return conflict_response(result)
+        if not result:
+            return json_error(404, f"No task with id {row_id}.")
+        return web.Response(status=204)
+
+    return await run_db(request, work)
+
+
+async def change_status(request:web.Request) -> web.Response:
+    data = await read_json(request)
+    if not isinstance(data, dict):
+        raise ValueError("Request body should be an object.")
+    row_ids = data.get("ids")
+    if not isinstance(row_ids, list) or not all(
+        isinstance(row_id, int) and not isinstance(row_id, bool) for row_id in row_ids
+    ):
+        raise ValueError("'ids' should be a list of integers.")
+    status = parse_status(data.get("status"))
+
+    def work(controller):
+        return [task.id for task in controller.set_status(row_ids=row_ids, status=status)]
+
+    return web.json_response({"updated": await run_db(request, work)})
+
+
+# ---
+# APP
+
+def create_app(*, session_factory=None, workers:int=DEFAULT_WORKERS) -> web.Application:
+    app = web.Application(middlewares=[error_middleware])
+    app[session_factory_key] = session_factory or db.Session
+    app[executor_key] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chromatic-db")
+
+    async def shutdown_executor(app):
+        app[executor_key].shutdown(wait=True)
+
+    app.on_cleanup.append(shutdown_executor)
+    app.router.add_get("/tasks", list_tasks)
+    app.router.add_post("/tasks", create_task)
+    app.router.add_post("/tasks/status", change_status)
+    app.router.add_get("/tasks/{row_id}", get_task)
+    app.router.add_patch("/tasks/{row_id}", edit_task)
+    app.router.add_delete("/tasks/{row_id}", delete_task)
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the task database over HTTP/JSON.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="size of the database thread pool")
+    args = parser.parse_args(argv)
+
+    migrations.upgrade()
+    web.run_app(create_app(workers=args.workers), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
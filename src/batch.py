@@ -0,0 +1,188 @@
+import argparse, json, sys
+
+import db
+import migrations
+from controller import Controller
+from db import EditConflict
+from serialize import task_to_json, task_dict_from_json
+
+from sqlalchemy.exc import SQLAlchemyError
+
+
+# Headless entry point: reads JSON commands (one per line) and streams one
+# JSON result per command. Never imports the TUI.
+#
+#   {"op": "add", "task": {"title": "...", "category": "WORK"}}
+#   {"op": "edit", "id": 3, "task": {"status": "COMPLETE"}, "version": 2}
+#   {"op": "delete", "id": 3, "version": 2}
+#   {"op": "list"}
+#
+# "version" is optional: when given, the command fails if the task changed since.
+# Commands are applied in transactions of --batch-size commands. Results of a
+# batch are written once it is committed; if the commit fails, every command
+# of the batch is reported as rolled back.
+
+DEFAULT_BATCH_SIZE = 500
+
+
+class CommandError(Exception):
+    pass
+
+
+def parse_command(line:str) -> dict:
+    try:
+        command = json.loads(line)
+    except json.JSONDecodeError as error:
+        raise CommandError(f"Invalid JSON: {error.msg}")
+    if not isinstance(command, dict):
+        raise CommandError("Command should be an object.")
+    return command
+
+
+def get_row_id(command:dict) -> int:
+    row_id = command.get("id")
+    # bool is an int subclass: "id": true would mean task 1
+    if not isinstance(row_id, int) or isinstance(row_id, bool):
+        raise CommandError("Missing or invalid 'id'.")
+    return row_id
+
+
+def get_version(command:dict) -> int | None:
+    version = command.get("version")
+    if version is not None and (not isinstance(version, int) or isinstance(version, bool)):
+        raise CommandError("Invalid 'version'.")
+    return version
+
+
+def check_result(result, row_id:int):
+    if isinstance(result, EditConflict):
+        if result.current is None:
+            raise CommandError(f"Task {row_id} was deleted.")
+        raise CommandError(
+            f"Version conflict on task {row_id}: expected {result.expected_version}, "
+            f"current {result.current.version}."
+        )
+    if not result:
+        raise CommandError(f"No task with id {row_id}.")
+
+
+def run_command(controller:Controller, command:dict) -> dict:
+    op = command.get("op")
+    match op:
+        case "add":
+            task_dict = task_dict_from_json(command.get("task"))
+            task_instance = controller.add_task(task_dict=task_dict, commit=False)
+            return {"task": task_to_json(task_instance)}
+        case "edit":
+            row_id = get_row_id(command)
+            task_dict = task_dict_from_json(command.get("task"), partial=True)
+            task_instance = controller.edit_task(
+                row_id=row_id, task_dict=task_dict, expected_version=get_version(command), commit=False
+            )
+            check_result(task_instance, row_id)
+            return {"task": task_to_json(task_instance)}
+        case "delete":
+            row_id = get_row_id(command)
+            check_result(
+                controller.delete_task(row_id=row_id, expected_version=get_version(command), commit=False),
+                row_id
+            )
+            return {"id": row_id}
+        case "list":
+            return {"tasks": [
+                task_to_json(row[0], include_description=False) for row in controller.get_all_tasks()
+            ]}
+        case _:
+            raise CommandError(f"Unknown op: {op!r}")
+
+
+def make_result(line_number:int, command:dict|None, *, ok:bool, **fields) -> dict:
+    result = {"line": line_number, "ok": ok}
+    if command:
+        result["op"] = command.get("op")
+        if "ref" in command:
+            result["ref"] = command["ref"]
+    result.update(fields)
+    return result
+
+
+class BatchRunner:
+
+    def __init__(self, controller:Controller, *, output, batch_size:int=DEFAULT_BATCH_SIZE):
+        self.controller = controller
+        self.output = output
+        self.batch_size = max(1, batch_size)
+        self.pending = []
+        self.failures = 0
+
+    def feed(self, line_number:int, line:str):
+        command = None
+        try:
+            command = parse_command(line)
+            result = make_result(line_number, command, ok=True, **run_command(self.controller, command))
+        except (CommandError, ValueError) as error:
+            result = make_result(line_number, command, ok=False, error=str(error))
+        except SQLAlchemyError as error:
+            # The session has to be rolled back: the whole batch is lost
+            self.controller.rollback()
+            self.pending.append(make_result(line_number, command, ok=False, error=str(error)))
+            self.abort_batch(str(error))
+            return
+        self.pending.append(result)
+        if len(self.pending) >= self.batch_size:
+            self.commit_batch()
+
+    def commit_batch(self):
+        if not self.pending:
+            return
+        try:
+            self.controller.commit()
+        except SQLAlchemyError as error:
+            self.controller.rollback()
+            self.abort_batch(str(error))
+            return
+        self.flush_results()
+
+    def abort_batch(self, reason:str):
+        for result in self.pending:
+            if result["ok"] and result.get("op") != "list":
+                result["ok"] = False
+                result["error"] = f"Rolled back: {reason}"
+        self.flush_results()
+
+    def flush_results(self):
+        for result in self.pending:
+            if not result["ok"]:
+                self.failures += 1
+            self.output.write(json.dumps(result) + "\n")
+        self.output.flush()
+        self.pending = []
+
+    def run(self, lines):
+        for line_number, line in enumerate(lines, start=1):
+            if line.strip():
+                self.feed(line_number, line)
+        self.commit_batch()
+        return self.failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run task commands (JSON lines) without the TUI.")
+    parser.add_argument("file", nargs="?", help="file to read commands from (default: stdin)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="number of commands per transaction")
+    args = parser.parse_args(argv)
+
+    migrations.upgrade()
+    with db.DatabaseSession() as session:
+        runner = BatchRunner(Controller(session), output=sys.stdout, batch_size=args.batch_size)
+        if args.file:
+            with open(args.file, encoding="utf-8") as file:
+                failures = runner.run(file)
+        else:
+            failures = runner.run(sys.stdin)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
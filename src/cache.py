@@ -0,0 +1,89 @@
+import sys
+from collections import OrderedDict
+
+import db
+
+from sqlalchemy.engine import Row
+
+
+# Read-through cache for Controller lookups. Entries are keyed by query shape
+# (method name + arguments) and bounded both by count (LRU) and by an estimate
+# of their size in memory. The whole cache is dropped as soon as
+# db.write_generation moves, i.e. after any write or rollback in this process.
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+
+def estimate_size(value) -> int:
+    # Rough, cheap estimate: container + shallow size of every mapped attribute.
+    # Only touches already loaded state, so it never triggers a lazy load.
+    if value is None:
+        return 0
+    # Rows (e.g. get_all_tasks) have no __dict__: size what they hold
+    if isinstance(value, (list, tuple, Row)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    state = getattr(value, "__dict__", None)
+    if state is None:
+        return sys.getsizeof(value)
+    return sys.getsizeof(value) + sys.getsizeof(state) + sum(
+        sys.getsizeof(item) for key, item in state.items() if not key.startswith("_")
+    )
+
+
+class QueryCache:
+
+    def __init__(self, *, max_entries:int=DEFAULT_MAX_ENTRIES, max_bytes:int=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.generation = db.write_generation
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, loader):
+        self.check_generation()
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def check_generation(self):
+        if self.generation != db.write_generation:
+            self.clear()
+            self.generation = db.write_generation
+            self.invalidations += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
@@ -0,0 +1,63 @@
+import db
+from db import TaskInstance, EditConflict
+from enums import TaskCompletionStatus, TaskCategory
+
+
+class Controller:
+
+    def __init__(self, session, *, cache=None):
+        self.session = session
+        self.cache = cache
+
+    def cached(self, key:tuple, loader):
+        if self.cache is None:
+            return loader()
+        return self.cache.get(key, loader)
+
+    def add_task(self, *, task_dict:dict, commit:bool=True) -> TaskInstance:
+        return db.add_task(session=self.session, task_dict=task_dict, commit=commit)
+
+    def get_all_tasks(self) -> TaskInstance:
+        if self.cache is None:
+            return db.get_task_instances(self.session)
+        # A Result can only be iterated once, so the cache keeps its rows
+        return self.cache.get(("get_all_tasks",), lambda: list(db.get_task_instances(self.session)))
+
+    def get_tasks(self, *, status:TaskCompletionStatus|None=None, category:TaskCategory|None=None,
+                  limit:int|None=None, offset:int=0) -> list[TaskInstance]:
+        return self.cached(
+            ("get_tasks", status, category, limit, offset),
+            lambda: db.get_task_instances_page(
+                self.session, status=status, category=category, limit=limit, offset=offset
+            )
+        )
+
+    def get_task(self, *, row_id:int) -> TaskInstance:
+        return self.cached(
+            ("get_task", row_id),
+            lambda: db.get_task_instance(self.session, row_id=row_id)
+        )
+
+    def delete_task(self, *, row_id:int, expected_version:int|None=None, commit:bool=True) -> bool | EditConflict:
+        return db.delete_task(
+            session=self.session, row_id=row_id, expected_version=expected_version, commit=commit
+        )
+
+    def edit_task(self, *, row_id:int, task_dict:dict, expected_version:int|None=None,
+                  commit:bool=True) -> TaskInstance | EditConflict:
+        return db.edit_task(
+            session=self.session, row_id=row_id, task_dict=task_dict,
+            expected_version=expected_version, commit=commit
+        )
+
+    def set_status(self, *, row_ids:list[int], status:TaskCompletionStatus, commit:bool=True) -> list[TaskInstance]:
+        return db.set_tasks_status(session=self.session, row_ids=row_ids, status=status, commit=commit)
+
+    def get_revision(self) -> int:
+        return db.get_revision(self.session, TaskInstance.__tablename__)
+
+    def commit(self):
+        self.session.commit()
+
+    def rollback(self):
+        self.session.rollback()
@@ -1,17 +1,22 @@
-import datetime, os
+import base64, datetime, os, uuid, zlib
+from collections import defaultdict
+from dataclasses import dataclass
 
 from enums import TaskCompletionStatus, TaskCategory
 
-from sqlalchemy import create_engine
-from sqlalchemy import select, inspect
-from sqlalchemy import String, Integer, Enum, ForeignKey, Time
+from sqlalchemy import create_engine, event
+from sqlalchemy import select, insert, update, delete, inspect, type_coerce
+from sqlalchemy import String, Integer, ForeignKey, Time, LargeBinary, Boolean, JSON
 from sqlalchemy import Column, Table
+from sqlalchemy.types import TypeDecorator
 
+from sqlalchemy import orm
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
 from datetime import time
 
 DATABASE_URL = os.getenv("CHROMATIC_TASK_DATABASE_URL", "sqlite:///default.db")
@@ -25,31 +30,99 @@ class Base(DeclarativeBase):
     pass
 
 
+class EnumCode(TypeDecorator):
+    # Stores an Enum member as its integer value instead of its name
+    # (all enums in enums.py are int-valued). See migration 2 in migrations.py.
+    impl = Integer
+    cache_ok = True
+
+    def __init__(self, enum_class, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.enum_class = enum_class
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return self.enum_class(value).value
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self.enum_class(value)
+
+
+class CompressedText(TypeDecorator):
+    # Text stored as a blob: a one-byte marker, then either the UTF-8 text
+    # (short values) or its zlib compression (values over the threshold).
+    impl = LargeBinary
+    cache_ok = True
+
+    RAW = b"\x00"
+    ZLIB = b"\x01"
+    THRESHOLD = 256
+
+    @classmethod
+    def encode(cls, value:str) -> bytes:
+        data = value.encode("utf-8")
+        if len(data) > cls.THRESHOLD:
+            return cls.ZLIB + zlib.compress(data)
+        return cls.RAW + data
+
+    @classmethod
+    def decode(cls, data:bytes) -> str:
+        if data[:1] == cls.ZLIB:
+            return zlib.decompress(data[1:]).decode("utf-8")
+        return data[1:].decode("utf-8")
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return self.encode(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self.decode(value)
+
+
+def new_uid() -> str:
+    return uuid.uuid4().hex
+
+
 # ---
 # TABLES
 class TaskInstance(Base):
     __tablename__ = "task_instance"
     # REQUIRED
     id: Mapped[int] = mapped_column(primary_key=True)
+    # Identifies the task across database replicas (see sync.py)
+    uid: Mapped[str] = mapped_column(String(32), default=new_uid, unique=True, index=True)
     title: Mapped[str] = mapped_column(String(80))
-    status: Mapped[TaskCompletionStatus] = mapped_column(Enum(TaskCompletionStatus))
-    category: Mapped[TaskCategory] = mapped_column(Enum(TaskCategory))
+    status: Mapped[TaskCompletionStatus] = mapped_column(EnumCode(TaskCompletionStatus))
+    category: Mapped[TaskCategory] = mapped_column(EnumCode(TaskCategory))
     # OPTIONAL
-    description: Mapped[str | None] = mapped_column(String(), nullable=True)
+    # Compressed, and deferred: only loaded when accessed (not by table views)
+    description: Mapped[str | None] = mapped_column(CompressedText(), nullable=True, deferred=True)
     template_id: Mapped[int | None] = mapped_column(ForeignKey("task_template.id"), nullable=True)
     year_scheduled: Mapped[int | None] = mapped_column(Integer, nullable=True)
     month_scheduled: Mapped[int | None] = mapped_column(Integer, nullable=True)
     day_scheduled: Mapped[int | None] = mapped_column(Integer, nullable=True)
     time_scheduled: Mapped[datetime.time | None] = mapped_column(Time, nullable=True)
+    # Optimistic concurrency: every UPDATE/DELETE checks and bumps it
+    version: Mapped[int] = mapped_column(Integer, default=1)
 
-    def to_dict(self) -> dict:
+    __mapper_args__ = {"version_id_col": version}
+
+    def to_dict(self, *, include_description:bool=True) -> dict:
         task_dict = {
             "id": self.id,
             "title": self.title,
             "status": self.status,
-            "category": self.category
+            "category": self.category,
+            "version": self.version
         }
-        for key in ["description", "template_id"]:
+        keys = ["description", "template_id"] if include_description else ["template_id"]
+        for key in keys:
             if getattr(self, key):
                 task_dict[key] = getattr(self, key)
         date_dict = {
@@ -79,9 +152,47 @@ class TaskInstance(Base):
 class TaskTemplate(Base):
     __tablename__ = "task_template"
     id: Mapped[int] = mapped_column(primary_key=True)
+    uid: Mapped[str] = mapped_column(String(32), default=new_uid, unique=True, index=True)
     title: Mapped[str] = mapped_column(String(80))
     description: Mapped[str | None] = mapped_column(String(), nullable=True)
-    category: Mapped[TaskCategory | None] = mapped_column(Enum(TaskCategory), nullable=True)
+    category: Mapped[TaskCategory | None] = mapped_column(EnumCode(TaskCategory), nullable=True)
+
+
+class TableRevision(Base):
+    # Change counter per table, bumped in the same transaction as every write.
+    # Used as a cheap "has anything changed?" check (e.g. ETags in api.py).
+    __tablename__ = "table_revision"
+    table_name: Mapped[str] = mapped_column(String(40), primary_key=True)
+    revision: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class Replica(Base):
+    # Single row: who this database is, for sync purposes
+    __tablename__ = "replica"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    replica_id: Mapped[str] = mapped_column(String(32))
+    clock: Mapped[int] = mapped_column(Integer, default=0)  # Lamport clock
+    seq: Mapped[int] = mapped_column(Integer, default=0)  # last change_journal seq
+
+
+class ChangeJournal(Base):
+    # Latest state of every task/template row, stamped with the (clock,
+    # origin) of the change that produced it. seq orders entries locally,
+    # so a peer only needs the entries past the last seq it acknowledged.
+    __tablename__ = "change_journal"
+    table_name: Mapped[str] = mapped_column(String(40), primary_key=True)
+    row_uid: Mapped[str] = mapped_column(String(32), primary_key=True)
+    origin: Mapped[str] = mapped_column(String(32))
+    clock: Mapped[int] = mapped_column(Integer)
+    deleted: Mapped[bool] = mapped_column(Boolean, default=False)
+    data: Mapped[dict | None] = mapped_column(JSON, nullable=True)
+    # Field -> [clock, origin] of the change that last set it, so concurrent
+    # edits of different fields merge (see sync.merge_entries). NULL: every
+    # field has the entry's own stamp.
+    field_clocks: Mapped[dict | None] = mapped_column(JSON, nullable=True)
+    seq: Mapped[int] = mapped_column(Integer, index=True)
+    # Peer the entry was imported from, so it isn't sent back there
+    received_from: Mapped[str | None] = mapped_column(String(32), nullable=True)
 
 
 class DatabaseSession:
@@ -97,74 +208,410 @@ class DatabaseSession:
         self.session.close()
 
 
-def create_tables():
-    Base.metadata.create_all(engine)
-
-
 def get_session():
     with Session() as session:
         yield session
 
 
+# ---
+# REVISIONS
+
+# In-process write generation, bumped by every write and every rollback.
+# Lets caches in front of the read functions (see cache.py) drop stale entries
+# without querying the database.
+write_generation = 0
+
+def bump_write_generation():
+    global write_generation
+    write_generation += 1
+
+@event.listens_for(Session, "after_soft_rollback")
+def _on_rollback(session, previous_transaction):
+    bump_write_generation()
+
+def bump_revision(session, table_name:str):
+    # Applied once per transaction, when it commits (see _commit_revisions)
+    bump_write_generation()
+    session.info.setdefault("revision_pending", set()).add(table_name)
+
+@event.listens_for(orm.Session, "before_commit")
+def _commit_revisions(session):
+    for table_name in session.info.pop("revision_pending", ()):
+        result = session.execute(
+            update(TableRevision)
+            .where(TableRevision.table_name == table_name)
+            .values(revision=TableRevision.revision + 1)
+        )
+        if not result.rowcount:
+            session.add(TableRevision(table_name=table_name, revision=1))
+
+def get_revision(session, table_name:str) -> int:
+    revision = session.execute(
+        select(TableRevision.revision).where(TableRevision.table_name == table_name)
+    ).scalar()
+    return revision or 0
+
+
+# ---
+# CHANGE JOURNAL
+# Every flush that creates, changes or deletes tasks/templates records their
+# new state in change_journal (see ChangeJournal). Works on a Connection, so
+# migrations can use it too.
+
+JOURNALED_TABLES = [TaskTemplate.__table__, TaskInstance.__table__]
+
+def get_replica(connection):
+    replica = connection.execute(select(Replica.replica_id, Replica.clock, Replica.seq)).first()
+    if replica is None:
+        connection.execute(insert(Replica).values(id=1, replica_id=new_uid(), clock=0, seq=0))
+        replica = connection.execute(select(Replica.replica_id, Replica.clock, Replica.seq)).first()
+    return replica
+
+def advance_replica(connection, *, clock_at_least:int=0) -> tuple[str, int, int]:
+    # Ticks the Lamport clock (past any clock seen from peers) and the seq
+    replica = get_replica(connection)
+    clock = max(replica.clock, clock_at_least) + 1
+    seq = replica.seq + 1
+    connection.execute(update(Replica).values(clock=clock, seq=seq))
+    return replica.replica_id, clock, seq
+
+def snapshot_rows(connection, table, row_ids) -> dict[int, tuple[str, dict]]:
+    # Row id -> (uid, JSON-able data) for the journal
+    columns = list(table.c)
+    if table is TaskInstance.__table__:
+        # The description is kept as its stored CompressedText bytes, so
+        # journaling never decompresses it (see description_from_data)
+        columns = [
+            type_coerce(column, LargeBinary).label(column.name) if column.name == "description" else column
+            for column in columns
+        ]
+    rows = connection.execute(select(*columns).where(table.c.id.in_(row_ids))).all()
+    template_uids = {}
+    if table is TaskInstance.__table__:
+        template_ids = {row.template_id for row in rows if row.template_id}
+        if template_ids:
+            template_uids = dict(connection.execute(
+                select(TaskTemplate.id, TaskTemplate.uid).where(TaskTemplate.id.in_(template_ids))
+            ).all())
+    snapshots = {}
+    for row in rows:
+        data = {
+            "title": row.title,
+            "category": row.category.name if row.category else None,
+        }
+        if table is TaskInstance.__table__:
+            data.update({
+                "description_data": base64.b64encode(row.description).decode("ascii") if row.description else None,
+                "status": row.status.name,
+                "template_uid": template_uids.get(row.template_id),
+                "year_scheduled": row.year_scheduled,
+                "month_scheduled": row.month_scheduled,
+                "day_scheduled": row.day_scheduled,
+                "time_scheduled": row.time_scheduled.strftime("%H:%M") if row.time_scheduled else None,
+            })
+        else:
+            data["description"] = row.description
+        snapshots[row.id] = (row.uid, data)
+    return snapshots
+
+def description_from_data(data:dict) -> str | None:
+    # Journal data -> description text. Task descriptions are stored
+    # compressed (description_data); templates' (and older entries') as text.
+    if data.get("description_data"):
+        return CompressedText.decode(base64.b64decode(data["description_data"]))
+    return data.get("description")
+
+def read_journal(connection, table_name:str, row_uids) -> dict:
+    # Row uid -> current journal entry
+    row_uids = list(row_uids)
+    entries = {}
+    for start in range(0, len(row_uids), 500):
+        for entry in connection.execute(
+            select(ChangeJournal).where(
+                ChangeJournal.table_name == table_name,
+                ChangeJournal.row_uid.in_(row_uids[start:start + 500])
+            )
+        ).mappings():
+            entries[entry["row_uid"]] = dict(entry)
+    return entries
+
+def field_stamps(entry:dict) -> dict:
+    # Field -> (clock, origin) of a live journal entry
+    stamps = {field: (entry["clock"], entry["origin"]) for field in entry["data"]}
+    for field, stamp in (entry.get("field_clocks") or {}).items():
+        if field in stamps:
+            stamps[field] = tuple(stamp)
+    return stamps
+
+def stamp_fields(previous:dict|None, data:dict, stamp:tuple) -> dict:
+    # field_clocks for a local change: fields that kept their value keep
+    # their stamp, the others get this change's
+    if previous is None or previous["deleted"]:
+        return {field: list(stamp) for field in data}
+    stamps = field_stamps(previous)
+    return {
+        field: list(stamps[field] if field in stamps and previous["data"][field] == value else stamp)
+        for field, value in data.items()
+    }
+
+def write_journal(connection, entries:list[dict]):
+    # entries: dicts with the ChangeJournal columns. Replaces the rows' entries.
+    if not entries:
+        return
+    entries = list({(entry["table_name"], entry["row_uid"]): entry for entry in entries}.values())
+    uids = defaultdict(list)
+    for entry in entries:
+        uids[entry["table_name"]].append(entry["row_uid"])
+    for table_name, row_uids in uids.items():
+        for start in range(0, len(row_uids), 500):
+            connection.execute(delete(ChangeJournal).where(
+                ChangeJournal.table_name == table_name,
+                ChangeJournal.row_uid.in_(row_uids[start:start + 500])
+            ))
+    connection.execute(insert(ChangeJournal), entries)
+
+# Changed rows are collected at each flush and journaled once, just before
+# the transaction commits (batch mode flushes every command).
+
+def pending_journal(session) -> dict:
+    return session.info.setdefault("journal_pending", {"deletes": [], "changed": defaultdict(set)})
+
+@event.listens_for(orm.Session, "before_flush")
+def _collect_deletes(session, flush_context, instances):
+    if session.info.get("sync_import"):
+        # sync.import_bundle journals the changes it applies itself
+        return
+    # uids of deleted rows have to be read before the rows are gone
+    deletes = [
+        (obj.__tablename__, obj.uid) for obj in session.deleted
+        if isinstance(obj, (TaskInstance, TaskTemplate)) and obj.uid
+    ]
+    if deletes:
+        pending_journal(session)["deletes"] += deletes
+
+@event.listens_for(orm.Session, "after_flush")
+def _collect_changes(session, flush_context):
+    if session.info.get("sync_import"):
+        return
+    for obj in list(session.new) + [obj for obj in session.dirty if session.is_modified(obj)]:
+        if isinstance(obj, (TaskInstance, TaskTemplate)):
+            pending_journal(session)["changed"][obj.__tablename__].add(obj.id)
+
+@event.listens_for(orm.Session, "before_commit")
+def _journal_changes(session):
+    # Flush first: changes still pending in the session are collected by
+    # the flush, whatever other before_commit hooks did (or didn't) flush
+    session.flush()
+    if "journal_pending" not in session.info:
+        return
+    pending = session.info.pop("journal_pending")
+    connection = session.connection()
+    replica_id, clock, seq = advance_replica(connection)
+    stamp = {"origin": replica_id, "clock": clock, "seq": seq, "received_from": None}
+    entries = [
+        {"table_name": table_name, "row_uid": uid, "deleted": True, "data": None, **stamp}
+        for table_name, uid in pending["deletes"]
+    ]
+    for table in JOURNALED_TABLES:
+        if pending["changed"][table.name]:
+            snapshots = snapshot_rows(connection, table, pending["changed"][table.name]).values()
+            previous = read_journal(connection, table.name, [uid for uid, _ in snapshots])
+            entries += [
+                {"table_name": table.name, "row_uid": uid, "deleted": False, "data": data,
+                 "field_clocks": stamp_fields(previous.get(uid), data, (clock, replica_id)), **stamp}
+                for uid, data in snapshots
+            ]
+    write_journal(connection, entries)
+
+@event.listens_for(orm.Session, "after_transaction_end")
+def _discard_pending(session, transaction):
+    # Rolled back (or committed): nothing left to record
+    if transaction.parent is None:
+        session.info.pop("journal_pending", None)
+        session.info.pop("revision_pending", None)
+
+
+# ---
+# CONFLICTS
+
+@dataclass
+class EditConflict:
+    # Returned by edit_task/delete_task when the row changed (or disappeared)
+    # since the caller read it. Falsy, like the other failure results.
+    row_id: int
+    expected_version: int | None
+    current: TaskInstance | None
+
+    def __bool__(self):
+        return False
+
+def merge_task_dicts(*, base:dict, mine:dict, theirs:dict) -> tuple[dict, list[str]]:
+    # Three-way merge of an edit (mine) made on base, against the current
+    # row (theirs). Returns the merged dict and the keys both sides changed
+    # differently; for those, mine wins.
+    merged = {}
+    conflicts = []
+    for key, value in mine.items():
+        if value == base.get(key):
+            merged[key] = theirs.get(key, value)
+        else:
+            merged[key] = value
+            if theirs.get(key) not in (base.get(key), value):
+                conflicts.append(key)
+    return merged, conflicts
+
+def find_conflict(session, row_id:int, expected_version:int|None):
+    # Reloads the row (another process may have changed it) and compares versions
+    task_instance = session.get(TaskInstance, row_id, populate_existing=True)
+    if expected_version is None:
+        return task_instance, None
+    if task_instance is None or task_instance.version != expected_version:
+        return task_instance, EditConflict(row_id, expected_version, task_instance)
+    return task_instance, None
+
+def stale_conflict(session, row_id:int, expected_version:int|None):
+    # The version check in the UPDATE/DELETE itself failed: someone wrote
+    # between our read and our write
+    session.rollback()
+    return EditConflict(row_id, expected_version, session.get(TaskInstance, row_id, populate_existing=True))
+
+
 # ---
 # CRUD
 
-def add_task(*, session, task_dict:dict):
+# Passing commit=False leaves the transaction to the caller (e.g. batch mode):
+# changes are only flushed, and database errors are raised instead of swallowed.
+#
+# edit_task and delete_task take the version the caller last saw; if the row
+# has moved on since, nothing is written and an EditConflict is returned.
+
+def add_task(*, session, task_dict:dict, commit:bool=True):
     entry = TaskInstance(
         title=task_dict["title"],
         status=task_dict["status"],
         category=task_dict["category"],
-        # description=task.description,
+        description=task_dict.get("description"),
     )
     if task_dict["date"]:
         entry.set_date(task_dict["date"])
     try:
         session.add(entry)
+        bump_revision(session, TaskInstance.__tablename__)
+        if not commit:
+            session.flush()
+            return entry
         session.commit()
         session.refresh(entry)
         return entry
     except SQLAlchemyError:
+        if not commit:
+            raise
         return None
 
-def edit_task(*, session, row_id:int, task_dict:dict):
-    task_instance = session.get(TaskInstance, row_id)
+def edit_task(*, session, row_id:int, task_dict:dict, expected_version:int|None=None, commit:bool=True):
+    task_instance, conflict = find_conflict(session, row_id, expected_version)
+    if conflict is not None:
+        return conflict
     if not task_instance:
         return False
+    # All values are built first: an invalid one (e.g. hour 25) raises before
+    # the instance is touched, instead of leaving it half-edited in the session
+    values = {}
+    for key, value in task_dict.items():
+        if key == "date":
+            values["year_scheduled"] = value["year"]
+            values["month_scheduled"] = value["month"]
+            values["day_scheduled"] = value["day"]
+            if value["hour"]:
+                if value["mins"]:
+                    values["time_scheduled"] = time(hour=value["hour"], minute=value["mins"])
+                else:
+                    values["time_scheduled"] = time(hour=value["hour"])
+        else:
+            values[key] = value
     try:
-        for key, value in task_dict.items():
-            if key == "date":
-                setattr(task_instance, "year_scheduled", value["year"])
-                setattr(task_instance, "month_scheduled", value["month"])
-                setattr(task_instance, "day_scheduled", value["day"])
-                if value["hour"]:
-                    if value["mins"]:
-                        setattr(task_instance, "time_scheduled", time(hour=value["hour"], minute=value["mins"]))
-                    else:
-                        setattr(task_instance, "time_scheduled", time(hour=value["hour"]))
-            else:
-                setattr(task_instance, key, value)
+        for key, value in values.items():
+            setattr(task_instance, key, value)
+        bump_revision(session, TaskInstance.__tablename__)
+        if not commit:
+            session.flush()
+            return task_instance
         session.commit()
         return task_instance
 
+    except StaleDataError:
+        if not commit:
+            raise
+        return stale_conflict(session, row_id, expected_version)
     except SQLAlchemyError:
         session.rollback()
+        if not commit:
+            raise
         return False
 
-def delete_task(*, session, row_id:int):
-    task_instance = session.get(TaskInstance, row_id)
+def delete_task(*, session, row_id:int, expected_version:int|None=None, commit:bool=True):
+    task_instance, conflict = find_conflict(session, row_id, expected_version)
+    if conflict is not None:
+        return conflict
     if not task_instance:
         return False
     try:
         session.delete(task_instance)
+        bump_revision(session, TaskInstance.__tablename__)
+        if not commit:
+            session.flush()
+            return True
         session.commit()
         return True
+    except StaleDataError:
+        if not commit:
+            raise
+        return stale_conflict(session, row_id, expected_version)
     except SQLAlchemyError:
         session.rollback()
+        if not commit:
+            raise
         return False
 
+def set_tasks_status(*, session, row_ids:list[int], status:TaskCompletionStatus, commit:bool=True):
+    task_instances = session.scalars(
+        select(TaskInstance)
+        .where(TaskInstance.id.in_(row_ids))
+        .execution_options(populate_existing=True)
+    ).all()
+    if not task_instances:
+        return []
+    try:
+        for task_instance in task_instances:
+            task_instance.status = status
+        bump_revision(session, TaskInstance.__tablename__)
+        if not commit:
+            session.flush()
+            return task_instances
+        session.commit()
+        return task_instances
+    except SQLAlchemyError:
+        session.rollback()
+        if not commit:
+            raise
+        return []
+
 def get_task_instances(session):
     return session.execute(select(TaskInstance))
 
+def get_task_instances_page(session, *, status:TaskCompletionStatus|None=None,
+                            category:TaskCategory|None=None, limit:int|None=None, offset:int=0):
+    query = select(TaskInstance).order_by(TaskInstance.id)
+    if status is not None:
+        query = query.where(TaskInstance.status == status)
+    if category is not None:
+        query = query.where(TaskInstance.category == category)
+    if limit is not None:
+        query = query.limit(limit)
+    if offset:
+        query = query.offset(offset)
+    return session.scalars(query).all()
+
 def get_task_instance(session, row_id:int):
     return session.execute(
         select(TaskInstance).where(TaskInstance.id == row_id)
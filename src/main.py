@@ -1,34 +1,41 @@
+import argparse, contextlib, os, sys
+
 import tui
 import db
-from db import TaskInstance
-
-
-class Controller:
-
-    def __init__(self, session):
-        self.session = session
-
-    def add_task(self, *, task_dict:dict) -> TaskInstance:
-        return db.add_task(session=self.session, task_dict=task_dict)
-
-    def get_all_tasks(self) -> TaskInstance:
-        return db.get_task_instances(self.session)
-
-    def get_task(self, *, row_id:int) -> TaskInstance:
-        return db.get_task_instance(self.session, row_id=row_id)
-
-    def delete_task(self, *, row_id:int) -> bool:
-        return db.delete_task(session=self.session, row_id=row_id)
-
-    def edit_task(self, *, row_id:int, task_dict:dict) -> TaskInstance:
-        return db.edit_task(session=self.session, row_id=row_id, task_dict=task_dict)
-
-def main():
-    db.create_tables()
-    with db.DatabaseSession() as session:
-        controller = Controller(session)
-        app = tui.TasksApp(controller=controller)
+import migrations
+from cache import QueryCache
+from controller import Controller
+from tui.profiler import Profiler, ProfilerError
+
+
+def env_flag(name:str) -> bool:
+    return os.getenv(name, "").strip().lower() not in ("", "0", "false")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CHROMATIC Tasks")
+    parser.add_argument("--profile", action="store_true",
+                        default=env_flag("CHROMATIC_TASK_PROFILE"),
+                        help="time message handlers and rendering, print a summary on exit")
+    parser.add_argument("--profile-stacks", metavar="FILE",
+                        default=os.getenv("CHROMATIC_TASK_PROFILE_STACKS"),
+                        help="also sample stacks into a collapsed-stack (flamegraph) file")
+    args = parser.parse_args(argv)
+
+    profiler = None
+    if args.profile or args.profile_stacks:
+        profiler = Profiler(stacks_path=args.profile_stacks)
+
+    migrations.upgrade()
+    with db.DatabaseSession() as session, profiler or contextlib.nullcontext():
+        controller = Controller(session, cache=QueryCache())
+        app = tui.TasksApp(controller=controller, profiler=profiler)
         app.run()
+    if env_flag("CHROMATIC_TASK_CACHE_STATS"):
+        print(f"Query cache: {controller.cache.stats()}", file=sys.stderr)
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except ProfilerError as error:
+        sys.exit(f"Error: {error}")
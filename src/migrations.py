@@ -0,0 +1,449 @@
+import argparse, base64, sys
+
+import db
+from enums import TaskCompletionStatus, TaskCategory
+
+from sqlalchemy import create_engine, event
+from sqlalchemy import select, insert, update, delete, inspect, text, bindparam
+from sqlalchemy import Integer
+from sqlalchemy.orm import Mapped, mapped_column
+
+
+# Schema versioning. Every database records the version of its schema; on
+# startup upgrade() applies the missing migrations in order.
+#
+# A migration is a list of steps:
+# - SchemaStep: DDL statements, run in a single transaction.
+# - AddColumnStep: ALTER TABLE ... ADD COLUMN, unless the column exists.
+# - BackfillStep: an UPDATE (or a Python function, for conversions SQL can't
+#   do) applied to a table in id ranges of chunk_size rows, one transaction
+#   per chunk. The last id done is checkpointed in the same
+#   transaction, so an interrupted upgrade resumes where it stopped and no
+#   transaction ever holds the table for long.
+#
+# SQLite rewrites the whole table for DROP COLUMN (and can't change a
+# column's type or constraints at all), so those changes use rebuild_table():
+# a new table is filled in chunks and renamed into place, then the old one
+# is emptied in chunks before being dropped. Like the rest of the upgrade,
+# this assumes nothing writes to the table with the old schema meanwhile:
+# every entry point upgrades before opening its session.
+#
+# Migrations spell out the schemas they work with instead of reading the
+# models, which keep changing after them.
+#
+# New tables don't need a migration: create_all creates them. Migrations only
+# change tables that already exist. A table created during the same upgrade
+# already has the current model's columns: add columns to it with
+# AddColumnStep.
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+# ---
+# TABLES
+
+class SchemaVersion(db.Base):
+    __tablename__ = "schema_version"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    version: Mapped[int] = mapped_column(Integer)
+
+
+class MigrationProgress(db.Base):
+    __tablename__ = "migration_progress"
+    version: Mapped[int] = mapped_column(primary_key=True)
+    step: Mapped[int] = mapped_column(Integer, default=0)
+    checkpoint: Mapped[int] = mapped_column(Integer, default=0)
+
+
+def save_progress(connection, version:int, step:int, checkpoint:int=0):
+    result = connection.execute(
+        update(MigrationProgress)
+        .where(MigrationProgress.version == version)
+        .values(step=step, checkpoint=checkpoint)
+    )
+    if not result.rowcount:
+        connection.execute(
+            insert(MigrationProgress).values(version=version, step=step, checkpoint=checkpoint)
+        )
+
+
+def get_progress(connection, version:int) -> tuple[int, int]:
+    row = connection.execute(
+        select(MigrationProgress.step, MigrationProgress.checkpoint)
+        .where(MigrationProgress.version == version)
+    ).first()
+    if row is None:
+        return 0, 0
+    return row.step, row.checkpoint
+
+
+def get_version(connection) -> int | None:
+    return connection.execute(select(SchemaVersion.version)).scalar()
+
+
+# ---
+# STEPS
+
+class SchemaStep:
+    def __init__(self, *statements:str):
+        self.statements = statements
+
+    def run(self, engine, version:int, index:int, checkpoint:int, chunk_size:int, report):
+        with engine.begin() as connection:
+            for statement in self.statements:
+                connection.execute(text(statement))
+            save_progress(connection, version, index + 1)
+
+
+class AddColumnStep:
+    def __init__(self, table:str, column:str, definition:str):
+        self.table = table
+        self.column = column
+        self.definition = definition
+
+    def run(self, engine, version:int, index:int, checkpoint:int, chunk_size:int, report):
+        with engine.begin() as connection:
+            columns = {column["name"] for column in inspect(connection).get_columns(self.table)}
+            if self.column not in columns:
+                connection.execute(text(f"ALTER TABLE {self.table} ADD COLUMN {self.column} {self.definition}"))
+            save_progress(connection, version, index + 1)
+
+
+class BackfillStep:
+    # statement is an UPDATE using the :lower (exclusive) and :upper
+    # (inclusive) id bounds of the current chunk. Alternatively, apply is
+    # called as apply(connection, lower, upper).
+    def __init__(self, table:str, statement:str|None=None, *, apply=None):
+        self.table = table
+        self.statement = statement
+        self.apply = apply
+
+    def apply_chunk(self, connection, lower:int, upper:int):
+        if self.apply:
+            self.apply(connection, lower, upper)
+        else:
+            connection.execute(text(self.statement), {"lower": lower, "upper": upper})
+
+    def next_chunk(self, connection, lower:int, chunk_size:int) -> tuple[int | None, int]:
+        # Upper id bound and size of the next chunk
+        return connection.execute(text(
+            f"SELECT max(id), count(*) FROM (SELECT id FROM {self.table} "
+            f"WHERE id > :lower ORDER BY id LIMIT :limit)"
+        ), {"lower": lower, "limit": chunk_size}).one()
+
+    def run(self, engine, version:int, index:int, checkpoint:int, chunk_size:int, report):
+        with engine.connect() as connection:
+            remaining = connection.execute(
+                text(f"SELECT count(*) FROM {self.table} WHERE id > :lower"), {"lower": checkpoint}
+            ).scalar()
+        done = 0
+        while True:
+            with engine.begin() as connection:
+                upper, size = self.next_chunk(connection, checkpoint, chunk_size)
+                if upper is None:
+                    save_progress(connection, version, index + 1)
+                    return
+                self.apply_chunk(connection, checkpoint, upper)
+                save_progress(connection, version, index, upper)
+            checkpoint = upper
+            done += size
+            report(f"  {self.table}: {done}/{remaining} rows")
+
+
+class Migration:
+    def __init__(self, version:int, name:str, steps:list):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+
+# ---
+# MIGRATIONS
+
+def rebuild_table(table:str, create:str, *, copy:str|None=None, apply=None) -> list:
+    # Steps rebuilding table from {table}_new. create is its CREATE TABLE;
+    # rows are copied by copy, an INSERT INTO {table}_new ... SELECT using the
+    # :lower and :upper id bounds (or by apply(connection, lower, upper)).
+    # Indexes have to be created again afterwards.
+    return [
+        SchemaStep(f"DROP TABLE IF EXISTS {table}_new", create),
+        BackfillStep(table, copy, apply=apply),
+        # Renames only change the schema. With legacy_alter_table, foreign
+        # keys elsewhere keep referring to the name, i.e. to the new table.
+        SchemaStep(
+            "PRAGMA legacy_alter_table = ON",
+            f"ALTER TABLE {table} RENAME TO {table}_old",
+            f"ALTER TABLE {table}_new RENAME TO {table}",
+            "PRAGMA legacy_alter_table = OFF",
+        ),
+        # Dropping a full table frees all its pages at once, as slow as a
+        # rewrite: it's emptied in chunks first
+        BackfillStep(f"{table}_old", f"DELETE FROM {table}_old WHERE id > :lower AND id <= :upper"),
+        SchemaStep(f"DROP TABLE {table}_old"),
+    ]
+
+
+def enum_case(column:str, enum_class) -> str:
+    cases = " ".join(f"WHEN '{member.name}' THEN {member.value}" for member in enum_class)
+    return f"CASE {column} {cases} END"
+
+
+# task_instance columns as of migration 4
+V4_TASK_COLUMNS = [
+    "id", "title", "status", "category", "description", "template_id",
+    "year_scheduled", "month_scheduled", "day_scheduled", "time_scheduled", "version",
+]
+
+
+def compress_descriptions(connection, lower:int, upper:int):
+    columns = ", ".join(V4_TASK_COLUMNS)
+    rows = connection.execute(text(
+        f"SELECT {columns} FROM task_instance WHERE id > :lower AND id <= :upper"
+    ), {"lower": lower, "upper": upper}).mappings().all()
+    if not rows:
+        return
+    connection.execute(
+        text(
+            f"INSERT INTO task_instance_new ({columns}) "
+            f"VALUES ({', '.join(':' + column for column in V4_TASK_COLUMNS)})"
+        ),
+        [
+            {**row, "description": db.CompressedText.encode(row["description"]) if row["description"] else None}
+            for row in rows
+        ]
+    )
+
+
+# Columns migration 5 reads, and the journal data it builds from them (the
+# format of db.snapshot_rows at the time)
+V5_JOURNAL_COLUMNS = {
+    "task_template": ["id", "title", "description", "category"],
+    "task_instance": [
+        "id", "title", "status", "category", "description", "template_id",
+        "year_scheduled", "month_scheduled", "day_scheduled", "time_scheduled",
+    ],
+}
+
+
+def v5_journal_data(table:str, row, template_uids:dict) -> dict:
+    data = {
+        "title": row["title"],
+        "category": TaskCategory(row["category"]).name if row["category"] is not None else None,
+    }
+    if table == "task_template":
+        data["description"] = row["description"]
+        return data
+    data.update({
+        "description_data": base64.b64encode(row["description"]).decode("ascii") if row["description"] else None,
+        "status": TaskCompletionStatus(row["status"]).name,
+        "template_uid": template_uids.get(row["template_id"]),
+        "year_scheduled": row["year_scheduled"],
+        "month_scheduled": row["month_scheduled"],
+        "day_scheduled": row["day_scheduled"],
+        # Stored as HH:MM:SS.ffffff
+        "time_scheduled": row["time_scheduled"][:5] if row["time_scheduled"] else None,
+    })
+    return data
+
+
+def assign_uids(connection, table:str, lower:int, upper:int):
+    # Gives every row a uid, and journals it as a local change
+    rows = connection.execute(text(
+        f"SELECT {', '.join(V5_JOURNAL_COLUMNS[table])} FROM {table} WHERE id > :lower AND id <= :upper"
+    ), {"lower": lower, "upper": upper}).mappings().all()
+    if not rows:
+        return
+    uids = {row["id"]: db.new_uid() for row in rows}
+    connection.execute(
+        text(f"UPDATE {table} SET uid = :uid WHERE id = :id"),
+        [{"id": row_id, "uid": uid} for row_id, uid in uids.items()]
+    )
+    template_uids = {}
+    template_ids = {row["template_id"] for row in rows if row.get("template_id")}
+    if template_ids:
+        # Templates got their uids in the step before
+        template_uids = dict(connection.execute(
+            text("SELECT id, uid FROM task_template WHERE id IN :ids").bindparams(
+                bindparam("ids", expanding=True)
+            ), {"ids": list(template_ids)}
+        ).all())
+    replica_id, clock, seq = db.advance_replica(connection)
+    db.write_journal(connection, [
+        {"table_name": table, "row_uid": uids[row["id"]], "origin": replica_id, "clock": clock,
+         "deleted": False, "data": v5_journal_data(table, row, template_uids), "seq": seq,
+         "received_from": None}
+        for row in rows
+    ])
+
+
+MIGRATIONS = [
+    # The schema as created by create_all before versioning existed
+    Migration(1, "baseline", []),
+
+    # Enum columns: name strings ('SCHEDULED') -> integer codes (1).
+    # SQLite can't change a column's type in place: both tables are rebuilt.
+    Migration(2, "enum columns as integer codes", [
+        *rebuild_table("task_template", """
+            CREATE TABLE task_template_new (
+                id INTEGER NOT NULL,
+                title VARCHAR(80) NOT NULL,
+                description VARCHAR,
+                category INTEGER,
+                PRIMARY KEY (id)
+            )""", copy=(
+            f"INSERT INTO task_template_new (id, title, description, category) "
+            f"SELECT id, title, description, {enum_case('category', TaskCategory)} "
+            f"FROM task_template WHERE id > :lower AND id <= :upper"
+        )),
+        *rebuild_table("task_instance", """
+            CREATE TABLE task_instance_new (
+                id INTEGER NOT NULL,
+                title VARCHAR(80) NOT NULL,
+                status INTEGER NOT NULL,
+                category INTEGER NOT NULL,
+                description VARCHAR,
+                template_id INTEGER,
+                year_scheduled INTEGER,
+                month_scheduled INTEGER,
+                day_scheduled INTEGER,
+                time_scheduled TIME,
+                PRIMARY KEY (id),
+                FOREIGN KEY(template_id) REFERENCES task_template (id)
+            )""", copy=(
+            f"INSERT INTO task_instance_new (id, title, status, category, description, template_id, "
+            f"year_scheduled, month_scheduled, day_scheduled, time_scheduled) "
+            f"SELECT id, title, {enum_case('status', TaskCompletionStatus)}, "
+            f"{enum_case('category', TaskCategory)}, description, template_id, "
+            f"year_scheduled, month_scheduled, day_scheduled, time_scheduled "
+            f"FROM task_instance WHERE id > :lower AND id <= :upper"
+        )),
+    ]),
+
+    # Row version for optimistic concurrency (TaskInstance.version)
+    Migration(3, "task_instance version column", [
+        SchemaStep("ALTER TABLE task_instance ADD COLUMN version INTEGER NOT NULL DEFAULT 1"),
+    ]),
+
+    # TaskInstance.description: plain text -> CompressedText blob. The table
+    # is rebuilt, compressing descriptions on the way.
+    Migration(4, "compressed task descriptions", rebuild_table("task_instance", """
+        CREATE TABLE task_instance_new (
+            id INTEGER NOT NULL,
+            title VARCHAR(80) NOT NULL,
+            status INTEGER NOT NULL,
+            category INTEGER NOT NULL,
+            description BLOB,
+            template_id INTEGER,
+            year_scheduled INTEGER,
+            month_scheduled INTEGER,
+            day_scheduled INTEGER,
+            time_scheduled TIME,
+            version INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (id),
+            FOREIGN KEY(template_id) REFERENCES task_template (id)
+        )""", apply=compress_descriptions)),
+
+    # Stable uids for tasks/templates, and a change journal for sync.py.
+    # Existing rows are journaled as local changes, so a first sync sends them.
+    Migration(5, "row uids and change journal", [
+        # NOT NULL like in new databases; the backfill replaces the default
+        SchemaStep(
+            "ALTER TABLE task_template ADD COLUMN uid VARCHAR(32) NOT NULL DEFAULT ''",
+            "ALTER TABLE task_instance ADD COLUMN uid VARCHAR(32) NOT NULL DEFAULT ''",
+        ),
+        BackfillStep("task_template", apply=lambda connection, lower, upper: assign_uids(
+            connection, "task_template", lower, upper
+        )),
+        BackfillStep("task_instance", apply=lambda connection, lower, upper: assign_uids(
+            connection, "task_instance", lower, upper
+        )),
+        SchemaStep(
+            "CREATE UNIQUE INDEX ix_task_template_uid ON task_template (uid)",
+            "CREATE UNIQUE INDEX ix_task_instance_uid ON task_instance (uid)",
+        ),
+    ]),
+
+    # Per-field stamps in the change journal. Existing entries keep NULL:
+    # their fields all have the entry's stamp.
+    Migration(6, "change journal field stamps", [
+        AddColumnStep("change_journal", "field_clocks", "JSON"),
+    ]),
+]
+
+HEAD = MIGRATIONS[-1].version
+
+
+# ---
+# RUNNER
+
+def create_migration_engine(url):
+    # pysqlite only opens transactions before DML, so ALTER TABLE statements
+    # would be committed one by one. Emitting BEGIN ourselves makes each
+    # SchemaStep atomic. Kept to this engine: for the app's own long-lived
+    # sessions it would hold read locks between writes.
+    engine = create_engine(url)
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def disable_pysqlite_transactions(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def begin(connection):
+            connection.exec_driver_sql("BEGIN")
+    return engine
+
+
+def apply_migration(engine, migration:Migration, *, chunk_size:int, report):
+    with engine.connect() as connection:
+        step_index, checkpoint = get_progress(connection, migration.version)
+    if step_index or checkpoint:
+        report(f"Resuming migration {migration.version} ({migration.name}) at step {step_index + 1}")
+    else:
+        report(f"Applying migration {migration.version} ({migration.name})")
+    for index, step in enumerate(migration.steps):
+        if index < step_index:
+            continue
+        step.run(engine, migration.version, index, checkpoint if index == step_index else 0, chunk_size, report)
+    with engine.begin() as connection:
+        connection.execute(update(SchemaVersion).values(version=migration.version))
+        connection.execute(delete(MigrationProgress).where(MigrationProgress.version == migration.version))
+
+
+def upgrade(engine=None, *, chunk_size:int=DEFAULT_CHUNK_SIZE, report=None) -> int:
+    engine = create_migration_engine((engine or db.engine).url)
+    try:
+        return upgrade_with(engine, chunk_size=chunk_size, report=report)
+    finally:
+        engine.dispose()
+
+
+def upgrade_with(engine, *, chunk_size:int, report) -> int:
+    report = report or (lambda message: None)
+    is_new = not inspect(engine).has_table(db.TaskInstance.__tablename__)
+    db.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        version = get_version(connection)
+        if version is None:
+            # New databases are created with the current schema; existing
+            # ones predate versioning.
+            version = HEAD if is_new else 0
+            connection.execute(insert(SchemaVersion).values(id=1, version=version))
+    for migration in MIGRATIONS:
+        if migration.version > version:
+            apply_migration(engine, migration, chunk_size=chunk_size, report=report)
+            version = migration.version
+    return version
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upgrade the task database schema.")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="rows per transaction when backfilling data")
+    args = parser.parse_args(argv)
+
+    version = upgrade(chunk_size=args.chunk_size, report=lambda message: print(message, file=sys.stderr))
+    print(f"Schema at version {version}.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
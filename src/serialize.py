@@ -0,0 +1,87 @@
+from enums import TaskCompletionStatus, TaskCategory
+
+
+DATE_KEYS = ["year", "month", "day", "hour", "mins"]
+# Allowed (min, max) for each date field
+DATE_RANGES = {"year": (1, 9999), "month": (1, 12), "day": (1, 31), "hour": (0, 23), "mins": (0, 59)}
+
+
+def empty_date() -> dict:
+    return {key: None for key in DATE_KEYS}
+
+
+# ---
+# OUTPUT
+
+# Lists leave descriptions out (include_description=False): they are stored
+# apart and would cost one extra load per task.
+def task_to_json(task_instance, *, include_description:bool=True) -> dict:
+    task_dict = task_instance.to_dict(include_description=include_description)
+    task_dict["status"] = task_dict["status"].name
+    task_dict["category"] = task_dict["category"].name
+    return task_dict
+
+
+# ---
+# INPUT
+
+def parse_status(value) -> TaskCompletionStatus:
+    try:
+        return TaskCompletionStatus[str(value).upper()]
+    except KeyError:
+        raise ValueError(f"Unknown status: {value!r}")
+
+
+def parse_category(value) -> TaskCategory:
+    try:
+        return TaskCategory[str(value).upper()]
+    except KeyError:
+        raise ValueError(f"Unknown category: {value!r}")
+
+
+def parse_date(value) -> dict:
+    if value is None:
+        return empty_date()
+    if not isinstance(value, dict):
+        raise ValueError("Date should be an object.")
+    date = empty_date()
+    for key in DATE_KEYS:
+        if value.get(key) is not None:
+            try:
+                date[key] = int(value[key])
+            except (TypeError, ValueError):
+                raise ValueError(f"Date {key} should be a number.")
+            lowest, highest = DATE_RANGES[key]
+            if not lowest <= date[key] <= highest:
+                raise ValueError(f"Date {key} should be between {lowest} and {highest}.")
+    return date
+
+
+# With partial=True (edits), only the keys present in the object are kept.
+def task_dict_from_json(data:dict, *, partial:bool=False) -> dict:
+    if not isinstance(data, dict):
+        raise ValueError("Task should be an object.")
+    task_dict = {}
+    if "title" in data or not partial:
+        title = data.get("title")
+        if not isinstance(title, str) or not 1 <= len(title) <= 80:
+            raise ValueError("Title should be a string of 1 to 80 characters.")
+        task_dict["title"] = title
+    if "description" in data:
+        description = data["description"]
+        if description is not None and not isinstance(description, str):
+            raise ValueError("Description should be a string.")
+        task_dict["description"] = description or None
+    if "category" in data or not partial:
+        task_dict["category"] = parse_category(data.get("category"))
+    if "status" in data:
+        task_dict["status"] = parse_status(data["status"])
+    elif not partial:
+        task_dict["status"] = TaskCompletionStatus.PENDING
+    if "date" in data or not partial:
+        task_dict["date"] = parse_date(data.get("date"))
+        # Same rule as the "create task" form
+        if (not partial and task_dict["date"]["year"]
+                and task_dict["status"] == TaskCompletionStatus.PENDING):
+            task_dict["status"] = TaskCompletionStatus.SCHEDULED
+    return task_dict
@@ -0,0 +1,323 @@
+import argparse, asyncio, contextlib, json, os, random, sys, tempfile, time, tracemalloc
+
+import db
+import migrations
+from cache import QueryCache
+from controller import Controller
+from enums import TaskCompletionStatus, TaskCategory
+from serialize import empty_date
+
+from sqlalchemy import create_engine
+from textual.widgets import ContentSwitcher, Input
+
+import tui
+from tui import TasksTable, EditTaskPopup
+
+
+# Long-running soak test: drives TasksApp headlessly (Textual's pilot) with
+# random create/edit/mark-complete/delete actions against a large database,
+# for hours if needed. At every sample interval it records per-action
+# latency, RSS and the top tracemalloc allocators. At the end it fits a line
+# through latency and memory over time and fails (exit code 1) if either
+# grows faster than its budget.
+#
+#   python soak.py --duration 4h --rows 50000 --output soak.jsonl
+
+ACTIONS = {"create": 3, "edit": 3, "complete": 3, "delete": 1}
+
+
+def parse_duration(text:str) -> float:
+    units = {"s": 1, "m": 60, "h": 3600}
+    if text[-1:] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def current_rss() -> int:
+    # Bytes. /proc is Linux only; elsewhere, fall back to the peak RSS.
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def slope(points:list[tuple[float, float]]) -> float:
+    # Least-squares slope of y over x
+    if len(points) < 2:
+        return 0.0
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if not variance:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+def percentile(values:list[float], fraction:float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def seed_database(session, rows:int):
+    controller = Controller(session)
+    existing = session.query(db.TaskInstance).count()
+    for index in range(existing, rows):
+        controller.add_task(task_dict=random_task(index), commit=False)
+        if index % 1000 == 999:
+            controller.commit()
+    controller.commit()
+
+
+def random_task(index:int) -> dict:
+    date = empty_date()
+    status = TaskCompletionStatus.PENDING
+    if random.random() < 0.5:
+        date.update(year=2025, month=random.randint(1, 12), day=random.randint(1, 28))
+        status = TaskCompletionStatus.SCHEDULED
+    return {
+        "title": f"Soak task {index}",
+        "status": status,
+        "category": random.choice(list(TaskCategory)),
+        "date": date,
+    }
+
+
+class Soak:
+
+    def __init__(self, app, pilot, *, session, sample_interval:float, output, top_allocators:int):
+        self.app = app
+        self.pilot = pilot
+        self.session = session
+        self.sample_interval = sample_interval
+        self.output = output
+        self.top_allocators = top_allocators
+        self.latencies = {action: [] for action in ACTIONS}
+        self.window = []
+        self.samples = []
+        self.created = 0
+        self.baseline_snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+
+    # ---
+    # Actions
+
+    @property
+    def table(self) -> TasksTable:
+        return self.app.query_one(TasksTable)
+
+    async def show_table(self):
+        self.app.query_one(ContentSwitcher).current = "data-table"
+        self.table.focus()
+        await self.pilot.pause()
+
+    async def select_random_row(self) -> bool:
+        await self.show_table()
+        if not self.table.row_count:
+            return False
+        self.table.move_cursor(row=random.randrange(self.table.row_count))
+        return True
+
+    async def create(self):
+        self.app.query_one(ContentSwitcher).current = "create-task"
+        title_input = self.app.query_one("#new-task-title", Input)
+        title_input.value = f"Soak created {self.created}"
+        title_input.focus()
+        self.created += 1
+        await self.pilot.press("enter")
+
+    async def edit(self):
+        if not await self.select_random_row():
+            return await self.create()
+        await self.pilot.press("enter")
+        await self.pilot.pause()
+        if isinstance(self.app.screen, EditTaskPopup):
+            self.app.screen.query_one("#edit-task-title", Input).value = f"Soak edited {time.monotonic():.0f}"
+            await self.pilot.click("#submit")
+
+    async def complete(self):
+        if not await self.select_random_row():
+            return await self.create()
+        await self.pilot.press("m")
+
+    async def delete(self):
+        if not await self.select_random_row():
+            return await self.create()
+        await self.pilot.press("backspace")
+
+    async def run_action(self, action:str):
+        start = time.perf_counter()
+        await getattr(self, action)()
+        await self.pilot.pause()
+        elapsed = time.perf_counter() - start
+        self.latencies[action].append(elapsed)
+        self.window.append(elapsed)
+        # Leave any popup left open (e.g. a failed submit)
+        while isinstance(self.app.screen, EditTaskPopup):
+            self.app.pop_screen()
+            await self.pilot.pause()
+
+    # ---
+    # Sampling
+
+    def take_sample(self, elapsed:float):
+        sample = {
+            "elapsed_s": round(elapsed, 1),
+            "actions": len(self.window),
+            "latency_mean_ms": 1000 * sum(self.window) / len(self.window) if self.window else None,
+            "latency_p99_ms": 1000 * percentile(self.window, 0.99) if self.window else None,
+            "rss_mb": current_rss() / 2 ** 20,
+            "identity_map": len(self.session.identity_map),
+            "table_rows": self.table.row_count,
+        }
+        if self.baseline_snapshot:
+            traced, _ = tracemalloc.get_traced_memory()
+            sample["traced_mb"] = traced / 2 ** 20
+            sample["top_allocators"] = self.top_growth(self.top_allocators)
+        self.samples.append(sample)
+        self.window = []
+        if self.output:
+            self.output.write(json.dumps(sample) + "\n")
+            self.output.flush()
+        print(
+            f"[{sample['elapsed_s']:>8.0f}s] actions {sample['actions']:>5}  "
+            f"mean {sample['latency_mean_ms'] or 0:7.2f} ms  rss {sample['rss_mb']:7.1f} MB  "
+            f"identity map {sample['identity_map']}", file=sys.stderr
+        )
+
+    def top_growth(self, limit:int) -> list[dict]:
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        return [
+            {"where": str(stat.traceback), "size_kb": stat.size / 1024, "growth_kb": stat.size_diff / 1024}
+            for stat in snapshot.compare_to(self.baseline_snapshot, "lineno")[:limit]
+        ]
+
+    async def run(self, duration:float):
+        start = time.monotonic()
+        next_sample = start + self.sample_interval
+        actions, weights = list(ACTIONS), list(ACTIONS.values())
+        while (now := time.monotonic()) - start < duration:
+            await self.run_action(random.choices(actions, weights)[0])
+            if now >= next_sample:
+                self.take_sample(now - start)
+                next_sample += self.sample_interval
+        self.take_sample(time.monotonic() - start)
+
+
+# ---
+# Report
+
+def check_budgets(soak:Soak, *, warmup:float, max_latency_slope:float, max_memory_slope:float) -> bool:
+    # The first sample covers app startup (first queries, caches filling
+    # up), so it's never part of the fit
+    samples = [sample for sample in soak.samples[1:] if sample["elapsed_s"] >= warmup]
+    latency_points = [
+        (sample["elapsed_s"] / 3600, sample["latency_mean_ms"])
+        for sample in samples if sample["latency_mean_ms"] is not None
+    ]
+    memory_points = [(sample["elapsed_s"] / 3600, sample["rss_mb"]) for sample in samples]
+    latency_slope = slope(latency_points)
+    memory_slope = slope(memory_points)
+
+    print("\nAction latency (ms):", file=sys.stderr)
+    for action, values in soak.latencies.items():
+        if values:
+            print(
+                f"  {action:<10} n={len(values):<7} p50 {1000 * percentile(values, 0.5):7.2f}  "
+                f"p99 {1000 * percentile(values, 0.99):7.2f}  max {1000 * max(values):7.2f}", file=sys.stderr
+            )
+    if soak.samples and soak.samples[-1].get("top_allocators"):
+        print("\nTop allocators (growth since start):", file=sys.stderr)
+        for allocator in soak.samples[-1]["top_allocators"]:
+            print(f"  {allocator['growth_kb']:+10.1f} KB  {allocator['where']}", file=sys.stderr)
+
+    if len(samples) < 2:
+        # No data is not a pass
+        print("\nNot enough samples after warmup to fit slopes: FAILED.", file=sys.stderr)
+        return False
+    passed = True
+    for name, value, budget, unit in [
+        ("Latency", latency_slope, max_latency_slope, "ms/h"),
+        ("Memory", memory_slope, max_memory_slope, "MB/h"),
+    ]:
+        ok = value <= budget
+        passed = passed and ok
+        print(
+            f"{name} slope: {value:+.2f} {unit} (budget {budget} {unit}) {'OK' if ok else 'FAILED'}",
+            file=sys.stderr
+        )
+    return passed
+
+
+async def soak_app(args, session) -> bool:
+    controller = Controller(session, cache=QueryCache())
+    app = tui.TasksApp(controller=controller)
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    try:
+        async with app.run_test(size=(120, 40)) as pilot:
+            soak = Soak(
+                app, pilot, session=session, sample_interval=args.sample_interval,
+                output=output, top_allocators=args.top_allocators
+            )
+            await soak.run(args.duration)
+    finally:
+        if output:
+            output.close()
+    return check_budgets(
+        soak, warmup=args.warmup,
+        max_latency_slope=args.max_latency_slope, max_memory_slope=args.max_memory_slope
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Soak test TasksApp for latency drift and memory growth.")
+    parser.add_argument("--duration", type=parse_duration, default=parse_duration("1h"),
+                        help="how long to run, e.g. 90s, 30m, 4h (default: 1h)")
+    parser.add_argument("--rows", type=int, default=20000, help="tasks in the database before starting")
+    parser.add_argument("--database", help="SQLite file to use (default: a temporary file)")
+    parser.add_argument("--sample-interval", type=parse_duration, default=parse_duration("60s"))
+    parser.add_argument("--warmup", type=parse_duration, default=parse_duration("5m"),
+                        help="ignore samples taken before this point when fitting slopes (default: 5m)")
+    parser.add_argument("--max-latency-slope", type=float, default=5.0,
+                        help="budget for mean action latency growth, in ms per hour")
+    parser.add_argument("--max-memory-slope", type=float, default=50.0,
+                        help="budget for RSS growth, in MB per hour")
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false",
+                        help="don't trace allocations (lower overhead)")
+    parser.add_argument("--top-allocators", type=int, default=10)
+    parser.add_argument("--seed", type=int, help="random seed, to replay a run")
+    parser.add_argument("--output", help="write samples to this file (JSON lines)")
+    args = parser.parse_args(argv)
+    # Slopes are fitted on the samples after the warmup, leaving out the
+    # startup one: at least two of them are needed
+    if args.duration < max(args.warmup, args.sample_interval) + 2 * args.sample_interval:
+        parser.error(
+            "--duration is too short to fit slopes: it should be at least "
+            "max(--warmup, --sample-interval) + 2 * --sample-interval."
+        )
+
+    random.seed(args.seed)
+    with contextlib.ExitStack() as cleanup:
+        database = args.database
+        if not database:
+            directory = cleanup.enter_context(tempfile.TemporaryDirectory(prefix="chromatic-soak-"))
+            database = os.path.join(directory, "soak.db")
+        engine = create_engine(f"sqlite:///{database}")
+        cleanup.callback(engine.dispose)
+        db.Session.configure(bind=engine)
+        migrations.upgrade(engine)
+
+        with db.DatabaseSession() as session:
+            print(f"Seeding {database} with {args.rows} tasks...", file=sys.stderr)
+            seed_database(session, args.rows)
+            if args.tracemalloc:
+                tracemalloc.start()
+            passed = asyncio.run(soak_app(args, session))
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+import argparse, datetime, json, sys, zlib
+
+import db
+import migrations
+from db import TaskInstance, TaskTemplate, ChangeJournal
+from enums import TaskCompletionStatus, TaskCategory
+
+from sqlalchemy import create_engine, select, insert, update, String, Integer
+from sqlalchemy.orm import sessionmaker, Mapped, mapped_column
+
+
+# Offline delta sync between database replicas (e.g. one SQLite file per
+# machine), built on the change journal kept by db.py.
+#
+# - Every database has a replica id and a Lamport clock. Each task/template
+#   row has a journal entry with its latest state, stamped (clock, origin).
+# - export_bundle() writes the entries a peer hasn't acknowledged yet (by
+#   local seq), one per changed row, whatever the number of edits.
+# - import_bundle() merges each entry with the local one field by field:
+#   every field keeps the value with the later stamp (higher clock wins,
+#   ties go to the higher replica id), so concurrent edits of different
+#   fields are all kept. Deletes are whole-row: the later of the delete and
+#   the other side's last change wins. Every replica ends up with the same
+#   rows whatever the order bundles arrive in.
+# - Bundles carry acknowledgements back, so the next export to that peer
+#   starts where the last one it received stopped.
+
+BUNDLE_FORMAT = 2
+# Format 1 entries have no field stamps: they merge as whole rows
+READABLE_FORMATS = {1, 2}
+IMPORT_ORDER = [TaskTemplate.__tablename__, TaskInstance.__tablename__]
+
+
+class SyncPeer(db.Base):
+    __tablename__ = "sync_peer"
+    peer_id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    # Highest of our seqs the peer has confirmed receiving
+    acked: Mapped[int] = mapped_column(Integer, default=0)
+    # Highest of the peer's seqs we have imported
+    received: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class SyncError(Exception):
+    pass
+
+
+def get_peer(connection, peer_id:str):
+    peer = connection.execute(
+        select(SyncPeer.acked, SyncPeer.received).where(SyncPeer.peer_id == peer_id)
+    ).first()
+    if peer is None:
+        connection.execute(insert(SyncPeer).values(peer_id=peer_id, acked=0, received=0))
+        return 0, 0
+    return peer.acked, peer.received
+
+
+def get_replica_id(session) -> str:
+    return db.get_replica(session.connection()).replica_id
+
+
+# ---
+# EXPORT
+
+def export_bundle(session, peer_id:str) -> dict:
+    connection = session.connection()
+    replica = db.get_replica(connection)
+    acked, received = get_peer(connection, peer_id)
+    entries = connection.execute(
+        select(
+            ChangeJournal.table_name, ChangeJournal.row_uid, ChangeJournal.origin,
+            ChangeJournal.clock, ChangeJournal.deleted, ChangeJournal.data, ChangeJournal.field_clocks
+        )
+        .where(ChangeJournal.seq > acked)
+        .where((ChangeJournal.received_from == None) | (ChangeJournal.received_from != peer_id))
+        .order_by(ChangeJournal.seq)
+    ).all()
+    session.commit()
+    return {
+        "format": BUNDLE_FORMAT,
+        "replica": replica.replica_id,
+        "peer": peer_id,
+        "upto": replica.seq,
+        "ack": received,
+        "entries": [list(entry) for entry in entries],
+    }
+
+
+def write_bundle(bundle:dict, path:str):
+    with open(path, "wb") as file:
+        file.write(zlib.compress(json.dumps(bundle, separators=(",", ":")).encode("utf-8")))
+
+
+def read_bundle(path:str) -> dict:
+    with open(path, "rb") as file:
+        bundle = json.loads(zlib.decompress(file.read()).decode("utf-8"))
+    if bundle.get("format") not in READABLE_FORMATS:
+        raise SyncError(f"Unsupported bundle format: {bundle.get('format')!r}")
+    return bundle
+
+
+# ---
+# IMPORT
+
+def apply_entry(session, table_name:str, row_uid:str, deleted:bool, data:dict|None):
+    model = TaskTemplate if table_name == TaskTemplate.__tablename__ else TaskInstance
+    row = session.scalars(select(model).where(model.uid == row_uid)).first()
+    if deleted:
+        if row is not None:
+            session.delete(row)
+        return
+    if row is None:
+        row = model(uid=row_uid)
+        session.add(row)
+    row.title = data["title"]
+    row.description = db.description_from_data(data)
+    row.category = TaskCategory[data["category"]] if data["category"] else None
+    if model is TaskInstance:
+        row.status = TaskCompletionStatus[data["status"]]
+        row.template_id = None
+        if data["template_uid"]:
+            row.template_id = session.scalars(
+                select(TaskTemplate.id).where(TaskTemplate.uid == data["template_uid"])
+            ).first()
+        row.year_scheduled = data["year_scheduled"]
+        row.month_scheduled = data["month_scheduled"]
+        row.day_scheduled = data["day_scheduled"]
+        row.time_scheduled = None
+        if data["time_scheduled"]:
+            row.time_scheduled = datetime.time.fromisoformat(data["time_scheduled"])
+    # Flushed one by one so instances can find the templates just created
+    session.flush()
+
+
+def merge_entries(local:dict|None, remote:dict) -> dict | None:
+    # The entry to keep for a row, or None if the local one already has
+    # the latest of everything
+    if local is None:
+        return remote
+    if local["deleted"] or remote["deleted"]:
+        if (remote["clock"], remote["origin"]) > (local["clock"], local["origin"]):
+            return remote
+        return None
+    local_stamps = db.field_stamps(local)
+    remote_stamps = db.field_stamps(remote)
+    data, stamps = dict(local["data"]), dict(local_stamps)
+    for field, value in remote["data"].items():
+        if field not in stamps or remote_stamps[field] > stamps[field]:
+            data[field], stamps[field] = value, remote_stamps[field]
+    if stamps == local_stamps:
+        return None
+    clock, origin = max((local["clock"], local["origin"]), (remote["clock"], remote["origin"]))
+    return {
+        **remote, "clock": clock, "origin": origin, "data": data,
+        "field_clocks": {field: list(stamp) for field, stamp in stamps.items()},
+    }
+
+
+def import_bundle(session, bundle:dict) -> dict:
+    sender = bundle["replica"]
+    connection = session.connection()
+    local = db.get_replica(connection)
+    if sender == local.replica_id:
+        raise SyncError("Bundle was exported by this database.")
+    if bundle["peer"] != local.replica_id:
+        raise SyncError(f"Bundle was exported for replica {bundle['peer']}, not this one.")
+
+    entries = sorted(bundle["entries"], key=lambda entry: IMPORT_ORDER.index(entry[0]))
+    stats = {"applied": 0, "skipped": 0}
+    session.info["sync_import"] = True
+    try:
+        _, _, seq = db.advance_replica(
+            connection, clock_at_least=max((entry[3] for entry in entries), default=0)
+        )
+        journal = []
+        for table_name, row_uid, origin, clock, deleted, data, *field_clocks in entries:
+            remote = {
+                "table_name": table_name, "row_uid": row_uid, "origin": origin, "clock": clock,
+                "deleted": deleted, "data": data, "field_clocks": field_clocks[0] if field_clocks else None
+            }
+            current = db.read_journal(connection, table_name, [row_uid]).get(row_uid)
+            entry = merge_entries(current, remote)
+            if entry is None:
+                stats["skipped"] += 1
+                continue
+            apply_entry(session, table_name, row_uid, entry["deleted"], entry["data"])
+            # A merge the sender doesn't have yet goes back to it with the
+            # next export
+            merged = entry["data"] != data
+            journal.append({**entry, "seq": seq, "received_from": None if merged else sender})
+            stats["applied"] += 1
+        db.write_journal(connection, journal)
+
+        acked, received = get_peer(connection, sender)
+        connection.execute(
+            update(SyncPeer).where(SyncPeer.peer_id == sender).values(
+                acked=max(acked, bundle["ack"]), received=max(received, bundle["upto"])
+            )
+        )
+        if stats["applied"]:
+            for table_name in IMPORT_ORDER:
+                db.bump_revision(session, table_name)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.info.pop("sync_import", None)
+    return stats
+
+
+# ---
+# LOCAL PEERS
+
+def sync_sessions(session_a, session_b) -> tuple[dict, dict]:
+    # Two-way sync between two open databases. Returns the import stats
+    # of each side.
+    replica_a = get_replica_id(session_a)
+    replica_b = get_replica_id(session_b)
+    stats_b = import_bundle(session_b, export_bundle(session_a, replica_b))
+    stats_a = import_bundle(session_a, export_bundle(session_b, replica_a))
+    return stats_a, stats_b
+
+
+def open_database(url:str):
+    if "://" not in url:
+        url = f"sqlite:///{url}"
+    engine = create_engine(url)
+    migrations.upgrade(engine)
+    return sessionmaker(engine)()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sync task databases through delta bundles.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("id", help="print this database's replica id")
+    export_parser = commands.add_parser("export", help="write the changes a peer hasn't seen to a bundle")
+    export_parser.add_argument("peer", help="replica id of the peer")
+    export_parser.add_argument("file")
+    import_parser = commands.add_parser("import", help="apply a bundle from a peer")
+    import_parser.add_argument("file")
+    with_parser = commands.add_parser("with", help="two-way sync with another local database")
+    with_parser.add_argument("database", help="database URL or SQLite file path")
+    args = parser.parse_args(argv)
+
+    migrations.upgrade()
+    with db.Session() as session:
+        match args.command:
+            case "id":
+                print(get_replica_id(session))
+                session.commit()
+            case "export":
+                bundle = export_bundle(session, args.peer)
+                write_bundle(bundle, args.file)
+                print(f"Exported {len(bundle['entries'])} changes.", file=sys.stderr)
+            case "import":
+                stats = import_bundle(session, read_bundle(args.file))
+                print(f"Applied {stats['applied']} changes, skipped {stats['skipped']}.", file=sys.stderr)
+            case "with":
+                with open_database(args.database) as other:
+                    stats_local, stats_other = sync_sessions(session, other)
+                print(
+                    f"Applied {stats_local['applied']} changes here, "
+                    f"{stats_other['applied']} there.", file=sys.stderr
+                )
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except SyncError as error:
+        sys.exit(f"Error: {error}")
@@ -7,6 +7,7 @@ from textual.screen import ModalScreen
 from textual import on
 
 from enums import TaskCompletionStatus, TaskCategory, FormType
+from db import EditConflict, merge_task_dicts
 
 from .widgets import FormCouple, DateInput, TaskForm
 
@@ -57,6 +58,9 @@ class TasksTable(DataTable):
         if task_instances is None:
             task_instances = []
         self.task_instances = task_instances
+        # Row id -> version of the task the row shows, checked when it's
+        # deleted or marked complete
+        self.versions = {}
 
     def on_mount(self):
         self.cursor_type = "row"
@@ -96,6 +100,11 @@ class TasksTable(DataTable):
             date_time += f" | {self.time_to_string(task_instance.time_scheduled)}"
 
         self.add_row(title, status, date_time, key=task_instance.id)
+        self.versions[task_instance.id] = task_instance.version
+
+    def remove_row(self, row_key):
+        self.versions.pop(row_key.value, None)
+        return super().remove_row(row_key)
 
     def edit_row(self, *, row_key, task_dict:dict):
         self.update_cell(
@@ -111,6 +120,8 @@ class TasksTable(DataTable):
                 row_key=row_key, column_key="scheduled",
                 value=DateInput.date_to_str(task_dict["date"])
             )
+        if "version" in task_dict:
+            self.versions[row_key.value] = task_dict["version"]
 
     def get_row_by_id(self, row_id:int):
         for row_key, row in self.rows.items():
@@ -165,10 +176,12 @@ class NewTaskForm(Vertical):
 class EditTaskPopup(ModalScreen):
 
     class SubmitForm(Message):
-        def __init__(self, *, task_dict:dict, row_key:int):
+        def __init__(self, *, task_dict:dict, row_key:int, base_dict:dict):
             super().__init__()
             self.row_key = row_key
             self.task_dict = task_dict
+            # The task as it was when the popup was opened (or last refreshed)
+            self.base_dict = base_dict
 
     def __init__(self, *args, task_dict:dict, row_key, **kwargs):
         self.task_dict = task_dict
@@ -184,7 +197,15 @@ class EditTaskPopup(ModalScreen):
 
     @on(TaskForm.SubmitForm)
     def handle_submit(self, message):
-        self.post_message(self.SubmitForm(task_dict=message.task_dict, row_key=self.row_key))
+        self.post_message(self.SubmitForm(
+            task_dict=message.task_dict, row_key=self.row_key, base_dict=self.task_dict
+        ))
+
+    def refresh_task(self, *, task_dict:dict, form_dict:dict):
+        # Another instance changed the task: what it saved becomes the new
+        # base, and the form shows the merged values
+        self.task_dict = task_dict
+        self.query_one(TaskForm).populate_form(form_dict)
 
 # ---
 # Navigation
@@ -196,9 +217,10 @@ class Sidebar(ListView):
 # ---
 # App
 class TasksApp(App):
-    def __init__(self, controller, *args, **kwargs):
+    def __init__(self, controller, *args, profiler=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.controller = controller
+        self.profiler = profiler
         self.theme = "gruvbox"
         self.title = "CHROMATIC Tasks"
         self.ref_task_table = None
@@ -216,27 +238,57 @@ class TasksApp(App):
 
     def on_mount(self):
         self.ref_task_table = self.query_one(TasksTable)
+        if self.profiler:
+            self.profiler.watch_event_loop()
 
     def on_list_view_highlighted(self, event):
         self.query_one(ContentSwitcher).current = event.item.id
 
     @on(TasksTable.DeleteEntry)
     def delete_entry(self, message):
-        if self.controller.delete_task(row_id=message.row_key.value):
-            self.query_one(TasksTable).remove_row(message.row_key)
+        table = self.query_one(TasksTable)
+        result = self.controller.delete_task(
+            row_id=message.row_key.value, expected_version=table.versions.get(message.row_key.value)
+        )
+        if isinstance(result, EditConflict):
+            self.refresh_stale_row(row_key=message.row_key, conflict=result, action="delete")
+        elif result:
+            table.remove_row(message.row_key)
 
     @on(TasksTable.EditEntry)
     def edit_entry(self, message):
         task_instance = self.controller.get_task(row_id=message.row_key.value)
         if task_instance:
-            popup = EditTaskPopup(task_dict=task_instance.to_dict(), row_key=message.row_key)
+            # TaskForm has no description field: leave the deferred column unloaded
+            popup = EditTaskPopup(
+                task_dict=task_instance.to_dict(include_description=False), row_key=message.row_key
+            )
             self.push_screen(popup)
 
     @on(TasksTable.ChangeEntryStatus)
     def change_entry_status(self, message):
-        task_instance = self.controller.edit_task(row_id=message.row_key.value, task_dict={"status": message.status})
-        if task_instance:
-            self.query_one(TasksTable).edit_row(row_key=message.row_key, task_dict=task_instance.to_dict())
+        table = self.query_one(TasksTable)
+        task_instance = self.controller.edit_task(
+            row_id=message.row_key.value, task_dict={"status": message.status},
+            expected_version=table.versions.get(message.row_key.value)
+        )
+        if isinstance(task_instance, EditConflict):
+            self.refresh_stale_row(row_key=message.row_key, conflict=task_instance, action="update")
+        elif task_instance:
+            table.edit_row(row_key=message.row_key, task_dict=task_instance.to_dict(include_description=False))
+
+    def refresh_stale_row(self, *, row_key, conflict:EditConflict, action:str):
+        # The row was out of date: show the task as it is now, and let the
+        # user decide again
+        if conflict.current is None:
+            self.notify("This task was deleted in another window.", severity="error")
+            self.ref_task_table.remove_row(row_key)
+            return
+        self.ref_task_table.edit_row(row_key=row_key, task_dict=conflict.current.to_dict(include_description=False))
+        self.notify(
+            f"This task was changed in another window, {action} it again to confirm.",
+            severity="warning"
+        )
 
     @on(NewTaskForm.SubmitForm)
     def create_task(self, message):
@@ -246,7 +298,35 @@ class TasksApp(App):
 
     @on(EditTaskPopup.SubmitForm)
     def edit_task(self, message):
-        task = self.controller.edit_task(row_id=message.row_key.value, task_dict=message.task_dict)
-        if task:
-            self.ref_task_table.edit_row(row_key=message.row_key, task_dict=task.to_dict())
-            self.pop_screen()
\ No newline at end of file
+        self.save_edit(row_key=message.row_key, task_dict=message.task_dict, base_dict=message.base_dict)
+
+    def save_edit(self, *, row_key, task_dict:dict, base_dict:dict):
+        task = self.controller.edit_task(
+            row_id=row_key.value, task_dict=task_dict, expected_version=base_dict["version"]
+        )
+        if isinstance(task, EditConflict):
+            self.resolve_conflict(row_key=row_key, task_dict=task_dict, base_dict=base_dict, conflict=task)
+        elif task:
+            self.ref_task_table.edit_row(row_key=row_key, task_dict=task.to_dict(include_description=False))
+            self.pop_screen()
+
+    def resolve_conflict(self, *, row_key, task_dict:dict, base_dict:dict, conflict:EditConflict):
+        if conflict.current is None:
+            self.notify("This task was deleted in another window.", severity="error")
+            self.ref_task_table.remove_row(row_key)
+            self.pop_screen()
+            return
+        current_dict = conflict.current.to_dict(include_description=False)
+        self.ref_task_table.edit_row(row_key=row_key, task_dict=current_dict)
+        merged, conflicts = merge_task_dicts(base=base_dict, mine=task_dict, theirs=current_dict)
+        if not conflicts:
+            # The changes don't overlap: save both
+            self.save_edit(row_key=row_key, task_dict=merged, base_dict=current_dict)
+            return
+        self.notify(
+            f"Changed in another window meanwhile: {', '.join(conflicts)}. "
+            "Your values were kept, submit again to save them.",
+            severity="warning"
+        )
+        if isinstance(self.screen, EditTaskPopup):
+            self.screen.refresh_task(task_dict=current_dict, form_dict=merged)
\ No newline at end of file
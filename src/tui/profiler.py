@@ -0,0 +1,226 @@
+import asyncio, os, sys, threading, time
+from collections import defaultdict
+from inspect import isawaitable, isgeneratorfunction, signature
+
+import textual
+from textual.message_pump import MessagePump
+from textual.screen import Screen
+
+# Private: checked in Profiler.install(), so a Textual upgrade can't break
+# the app itself
+try:
+    from textual._callback import count_parameters
+except ImportError:
+    count_parameters = None
+
+
+# Latency profiler for the TUI. While installed, it times:
+# - every message handler (naming convention and @on(...) handlers alike),
+# - screen layout and compositor refreshes,
+# - event-loop lag (how late a periodic wake-up runs),
+# and can sample the main thread's stack into a collapsed-stack file that
+# flamegraph.pl / speedscope can read.
+#
+# Enabled from main.py with --profile or CHROMATIC_TASK_PROFILE=1.
+
+LAG_INTERVAL = 0.05
+SAMPLE_INTERVAL = 0.005
+
+
+class ProfilerError(Exception):
+    pass
+
+
+def check_textual_internals():
+    # The profiler patches Textual internals (written against Textual 1.0).
+    # Refuse to install if they changed, rather than patch the wrong thing.
+    problems = []
+    if count_parameters is None:
+        problems.append("textual._callback.count_parameters is missing")
+    dispatch = getattr(MessagePump, "_get_dispatch_methods", None)
+    if dispatch is None:
+        problems.append("MessagePump._get_dispatch_methods is missing")
+    elif not isgeneratorfunction(dispatch) or list(signature(dispatch).parameters) != ["self", "method_name", "message"]:
+        problems.append("MessagePump._get_dispatch_methods has changed")
+    for name in ["_refresh_layout", "_compositor_refresh"]:
+        if not callable(getattr(Screen, name, None)):
+            problems.append(f"Screen.{name} is missing")
+    if problems:
+        raise ProfilerError(
+            f"Profiling isn't supported with Textual {textual.__version__}: {'; '.join(problems)}."
+        )
+
+
+def percentile(values:list[float], fraction:float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Profiler:
+
+    def __init__(self, *, stacks_path:str|None=None, output=None):
+        self.stacks_path = stacks_path
+        self.output = output or sys.stderr
+        self.timings = defaultdict(list)  # name -> durations (seconds)
+        self.loop_lag = []
+        self.stacks = defaultdict(int)  # collapsed stack -> sample count
+        self.originals = {}
+        self.lag_task = None
+        self.sampler = None
+        self.sampling = threading.Event()
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
+        self.report()
+
+    # ---
+    # Timing
+
+    def record(self, name:str, start:float):
+        self.timings[name].append(time.perf_counter() - start)
+
+    def wrap_handler(self, name:str, method):
+        profiler = self
+
+        async def finish(result, start):
+            try:
+                return await result
+            finally:
+                profiler.record(name, start)
+
+        def timed(*params):
+            start = time.perf_counter()
+            result = method(*params)
+            if isawaitable(result):
+                return finish(result, start)
+            profiler.record(name, start)
+            return result
+
+        timed._param_count = count_parameters(method)
+        return timed
+
+    def wrap_refresh(self, name:str, method):
+        profiler = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                profiler.record(name, start)
+
+        return timed
+
+    def install(self):
+        check_textual_internals()
+        profiler = self
+        get_dispatch_methods = MessagePump._get_dispatch_methods
+
+        def timed_dispatch_methods(pump, method_name, message):
+            for cls, method in get_dispatch_methods(pump, method_name, message):
+                name = f"{cls.__name__}.{getattr(method, '__name__', method_name)}"
+                yield cls, profiler.wrap_handler(name, method)
+
+        self.originals = {
+            (MessagePump, "_get_dispatch_methods"): get_dispatch_methods,
+            (Screen, "_refresh_layout"): Screen._refresh_layout,
+            (Screen, "_compositor_refresh"): Screen._compositor_refresh,
+        }
+        MessagePump._get_dispatch_methods = timed_dispatch_methods
+        Screen._refresh_layout = self.wrap_refresh("[render] Screen._refresh_layout", Screen._refresh_layout)
+        Screen._compositor_refresh = self.wrap_refresh("[render] Screen._compositor_refresh", Screen._compositor_refresh)
+        if self.stacks_path:
+            self.start_sampler()
+
+    def uninstall(self):
+        for (cls, attribute), original in self.originals.items():
+            setattr(cls, attribute, original)
+        self.originals = {}
+        if self.lag_task:
+            self.lag_task.cancel()
+            self.lag_task = None
+        self.stop_sampler()
+
+    # ---
+    # Event loop lag
+
+    def watch_event_loop(self):
+        # Has to be called from inside the running loop (e.g. App.on_mount)
+        self.lag_task = asyncio.get_running_loop().create_task(self.measure_lag())
+
+    async def measure_lag(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.loop_lag.append(max(0.0, time.perf_counter() - start - LAG_INTERVAL))
+
+    # ---
+    # Stack sampling
+
+    def start_sampler(self):
+        main_thread_id = threading.main_thread().ident
+        self.sampling.set()
+
+        def sample():
+            while self.sampling.is_set():
+                frame = sys._current_frames().get(main_thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+                time.sleep(SAMPLE_INTERVAL)
+
+        self.sampler = threading.Thread(target=sample, name="chromatic-profiler", daemon=True)
+        self.sampler.start()
+
+    def stop_sampler(self):
+        if not self.sampler:
+            return
+        self.sampling.clear()
+        self.sampler.join()
+        self.sampler = None
+        with open(self.stacks_path, "w", encoding="utf-8") as file:
+            for stack, count in sorted(self.stacks.items()):
+                file.write(f"{stack} {count}\n")
+
+    # ---
+    # Report
+
+    def summary(self) -> list[dict]:
+        rows = []
+        for name, durations in self.timings.items():
+            rows.append({
+                "name": name,
+                "count": len(durations),
+                "total_ms": sum(durations) * 1000,
+                "p50_ms": percentile(durations, 0.50) * 1000,
+                "p99_ms": percentile(durations, 0.99) * 1000,
+                "max_ms": max(durations) * 1000,
+            })
+        rows.sort(key=lambda row: row["p99_ms"], reverse=True)
+        return rows
+
+    def report(self, limit:int=20):
+        write = lambda text: self.output.write(text + "\n")
+        write(f"{'Handler':<60} {'count':>7} {'total ms':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for row in self.summary()[:limit]:
+            write(
+                f"{row['name'][:60]:<60} {row['count']:>7} {row['total_ms']:>10.1f} "
+                f"{row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f}"
+            )
+        if self.loop_lag:
+            write(
+                f"Event loop lag: p50 {percentile(self.loop_lag, 0.50) * 1000:.2f} ms, "
+                f"p99 {percentile(self.loop_lag, 0.99) * 1000:.2f} ms, "
+                f"max {max(self.loop_lag) * 1000:.2f} ms ({len(self.loop_lag)} samples)"
+            )
+        if self.stacks_path:
+            write(f"Stack samples written to {self.stacks_path}")